@@ -3,31 +3,95 @@ LLMS extension for context compaction via /compact command.
 Uses llms.py's native API to call configured LLMs.
 """
 
+import asyncio
+import hashlib
 import json
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 
+def stdlib_json_dumps(obj):
+    """Compact, non-ASCII-escaped JSON text using the stdlib encoder."""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+# Both branches emit the same compact, non-ASCII-escaped JSON text
+try:
+    import orjson
+
+    def json_dumps(obj):
+        try:
+            return orjson.dumps(obj).decode()
+        except orjson.JSONEncodeError:
+            # e.g. lone surrogates, which orjson rejects and json accepts
+            return stdlib_json_dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = stdlib_json_dumps
+    json_loads = json.loads
+
+# Matches a /compact command at the start of a message
+COMPACT_COMMAND = re.compile(r'\s*/compact(?:\s|$)')
+
+# Number of recent summaries kept to skip repeated LLM calls
+SUMMARY_CACHE_SIZE = 64
+
+# Default number of threads whose compaction is remembered, least recently used evicted
+MAX_THREADS = 1024
+
+@dataclass
+class CompactBoundary:
+    """Compaction state remembered for a thread."""
+    __slots__ = ('summary_content', 'message_count', 'compactions', 'prefix_digest')
+
+    summary_content: str
+    message_count: int
+    compactions: int
+    prefix_digest: bytes
+
+def text_digest(text):
+    """Short digest identifying a conversation text."""
+    # surrogatepass: JSON can carry lone surrogates, which must still hash
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def load_config(config_path):
+    """Load the extension config, or an empty dict if there is none."""
+    if not config_path.exists():
+        return {}
+    return json_loads(config_path.read_bytes())
+
 def __install__(ctx):
     """
     Install hook - registers the /compact command filter.
     """
 
-    # Load configuration
-    config_path = Path(__file__).parent / "config.json"
-    config = {}
-
-    if config_path.exists():
-        with open(config_path, 'r') as f:
-            config = json.load(f)
+    # Load configuration once; __install__ must stay synchronous
+    config = load_config(Path(__file__).parent / "config.json")
 
     provider = config.get('provider', 'ollama')
     model = config.get('model', 'qwen2.5:7b')
     summary_prompt = config.get('summary_prompt', 'Summarize this conversation concisely.')
+    # Optional cap on summary length, to keep the compaction call short
+    summary_max_tokens = max(0, int(config.get('summary_max_tokens') or 0))
+    # Split history into this many blocks and summarize them concurrently
+    block_count = max(1, int(config.get('block_count', 1)))
+    # Re-summarize the full history every this many compactions to limit drift
+    full_recompaction_interval = max(1, int(config.get('full_recompaction_interval', 5)))
+    max_threads = max(1, int(config.get('max_threads', MAX_THREADS)))
+
+    # Per-request logging only when the server runs with DEBUG=1
+    debug = os.environ.get('DEBUG', '0') == '1'
 
     # Format the full model name as provider/model for llms.py
     full_model = f"{provider}/{model}" if provider else model
 
-    # Store compact boundaries per thread
-    compact_boundaries = {}
+    # Store compact boundaries per thread, least recently used first
+    compact_boundaries = OrderedDict()
+
+    # Recent summaries keyed by a digest of their input, oldest first
+    summary_cache = OrderedDict()
 
     async def compact_command_filter(chat, context):
         """Filter that handles /compact command and applies compaction."""
@@ -42,11 +106,8 @@ def __install__(ctx):
         if last_message.get('role') != 'user':
             return
 
-        content = last_message.get('content', '')
-        text_content = extract_text(content)
-
         # Check if this is a /compact command
-        if text_content and text_content.strip().startswith('/compact'):
+        if is_compact_command(last_message.get('content', '')):
             await handle_compact(chat, context, thread_id, full_model, summary_prompt, ctx)
         elif thread_id in compact_boundaries:
             apply_compaction(chat, thread_id, ctx)
@@ -56,8 +117,11 @@ def __install__(ctx):
 
         ctx.log(f"[context_compaction] ✓ /compact command (thread: {thread_id})")
 
-        last_message = chat['messages'][-1]
-        messages_to_compact = chat['messages'][:-1]
+        messages = chat['messages']
+        last_message = messages[-1]
+        # A leading system prompt is kept verbatim, so it is not summarized
+        start = 1 if keeps_system_prompt(messages, last_message) else 0
+        messages_to_compact = messages[start:-1]
 
         if len(messages_to_compact) == 0:
             update_text(last_message, "No conversation history to compact.")
@@ -66,57 +130,110 @@ def __install__(ctx):
         ctx.log(f"[context_compaction] Compacting {len(messages_to_compact)} messages")
 
         pre_tokens = estimate_tokens(messages_to_compact)
-        conversation_text = build_text(messages_to_compact)
+        prefix_digest = text_digest(build_text(messages_to_compact))
 
-        # Generate summary using llms.py's chat_completion API
-        summary = await generate_summary(conversation_text, full_model, summary_prompt, ctx)
+        # The previous summary only applies if it covers this exact history
+        boundary = compact_boundaries.get(thread_id)
+        if boundary and not summarized_prefix_matches(boundary, messages_to_compact, prefix_digest):
+            boundary = None
 
-        if not summary:
-            ctx.log(f"[context_compaction] Failed to generate summary")
-            update_text(last_message, "Failed to generate summary.")
-            return
+        if boundary and boundary.message_count == len(messages_to_compact):
+            # Retried /compact with nothing new; keep the previous summary
+            ctx.log(f"[context_compaction] No new messages, reusing previous summary")
+            summary_content = boundary.summary_content
+        else:
+            # Fold only the turns since the last compaction into its summary
+            if boundary and boundary.compactions < full_recompaction_interval:
+                new_messages = messages_to_compact[boundary.message_count:]
+                ctx.log(f"[context_compaction] Adding {len(new_messages)} new messages to previous summary")
+                source = [{"role": "system", "content": boundary.summary_content}] + new_messages
+                compactions = boundary.compactions + 1
+            else:
+                source = messages_to_compact
+                compactions = 1
 
-        ctx.log(f"[context_compaction] ✓ Summary: {len(summary)} chars")
+            # Generate summary using llms.py's chat_completion API
+            summary = await summarize(source, full_model, summary_prompt, ctx)
 
-        # Store boundary
-        compact_boundaries[thread_id] = {
-            'summary': summary,
-            'preTokens': pre_tokens,
-            'messageCount': len(messages_to_compact)
-        }
+            if not summary:
+                ctx.log(f"[context_compaction] Failed to generate summary")
+                update_text(last_message, "Failed to generate summary.")
+                return
 
-        # Replace with summary as system message + user's new prompt
-        system_msg = {
-            "role": "system",
-            "content": f"[Context: Previous conversation summary]\n\n{summary}"
-        }
+            ctx.log(f"[context_compaction] ✓ Summary: {len(summary)} chars")
+
+            # Build the summary context once; it is reused on every later request
+            summary_content = f"[Context: Previous conversation summary]\n\n{summary}"
+
+            # Store boundary
+            compact_boundaries[thread_id] = CompactBoundary(
+                summary_content=summary_content,
+                message_count=len(messages_to_compact),
+                compactions=compactions,
+                prefix_digest=prefix_digest
+            )
 
-        chat['messages'] = [system_msg]
+        compact_boundaries.move_to_end(thread_id)
+        if len(compact_boundaries) > max_threads:
+            compact_boundaries.popitem(last=False)
+
+        # Replace with summary as system message + user's new prompt
         update_text(last_message, "Continue our conversation. What would you like to discuss next?")
-        chat['messages'].append(last_message)
+        chat['messages'] = compacted_messages(chat['messages'], summary_content, last_message)
 
-        post_tokens = estimate_tokens(chat['messages'])
+        # Leave out the kept system prompt, as pre_tokens does
+        post_tokens = estimate_tokens(chat['messages'][start:])
         reduction = ((pre_tokens - post_tokens) / pre_tokens * 100) if pre_tokens > 0 else 0
         ctx.log(f"[context_compaction] ✓ Reduction: ~{reduction:.0f}% ({pre_tokens} -> {post_tokens})")
 
+    def summarized_prefix_matches(boundary, messages, digest):
+        """Check that messages start with the history the boundary summarized."""
+        count = boundary.message_count
+        if count > len(messages):
+            return False
+        if count < len(messages):
+            digest = text_digest(build_text(messages[:count]))
+        return digest == boundary.prefix_digest
+
     def apply_compaction(chat, thread_id, ctx):
         """Apply existing compaction to current request."""
 
         boundary = compact_boundaries[thread_id]
+        compact_boundaries.move_to_end(thread_id)
         original_count = len(chat['messages'])
 
-        # System message with summary
+        # Keep only the summary and the latest user message
+        chat['messages'] = compacted_messages(chat['messages'], boundary.summary_content, chat['messages'][-1])
+
+        if debug:
+            ctx.log(f"[context_compaction] Applied: {original_count} -> {len(chat['messages'])} messages")
+
+    def compacted_messages(messages, summary_content, last_message):
+        """
+        Build the compacted message list.
+        The original system prompt and the summary come first in a fixed order
+        so the prefix is identical across turns and server prompt caches hit.
+        """
         system_msg = {
             "role": "system",
-            "content": f"[Context: Previous conversation summary]\n\n{boundary['summary']}"
+            "content": summary_content
         }
-
-        # Keep only the latest user message
-        recent = chat['messages'][-1:]
-
-        chat['messages'] = [system_msg] + recent
-
-        ctx.log(f"[context_compaction] Applied: {original_count} -> {len(chat['messages'])} messages")
+        if keeps_system_prompt(messages, last_message):
+            return [messages[0], system_msg, last_message]
+        return [system_msg, last_message]
+
+    def keeps_system_prompt(messages, last_message):
+        """Whether the leading system prompt is kept ahead of the summary."""
+        first = messages[0]
+        return first is not last_message and first.get('role') == 'system'
+
+    def is_compact_command(content):
+        """Check whether message content is a /compact command."""
+        # Plain string content is checked directly, without walking blocks
+        if isinstance(content, str):
+            return COMPACT_COMMAND.match(content) is not None
+        text_content = extract_text(content)
+        return bool(text_content) and COMPACT_COMMAND.match(text_content) is not None
 
     def extract_text(content):
         """Extract text from message content."""
@@ -134,37 +251,62 @@ def __install__(ctx):
         else:
             message['content'] = text
 
+    def flatten_content(content):
+        """Join all text parts of message content into one string."""
+        if isinstance(content, list):
+            return ' '.join(p.get('text', '') if isinstance(p, dict) else str(p) for p in content)
+        return str(content)
+
     def build_text(messages):
         """Build conversation text."""
-        text = ""
-        for msg in messages:
-            role = msg.get('role', 'unknown')
-            content = msg.get('content', '')
-
-            if isinstance(content, list):
-                parts = []
-                for p in content:
-                    if isinstance(p, dict):
-                        parts.append(p.get('text', ''))
-                    else:
-                        parts.append(str(p))
-                content = ' '.join(parts)
-            else:
-                content = str(content)
-
-            text += f"{role}: {content}\n\n"
+        return ''.join(
+            f"{msg.get('role', 'unknown')}: {flatten_content(msg.get('content', ''))}\n\n"
+            for msg in messages
+        )
 
-        return text
+    def content_length(content):
+        """Character length of message content, serializing structured content."""
+        if isinstance(content, (dict, list)):
+            return len(json_dumps(content))
+        return len(str(content))
 
     def estimate_tokens(messages):
         """Estimate tokens (4 chars ≈ 1 token)."""
-        total = 0
-        for msg in messages:
-            content = msg.get('content', '')
-            if isinstance(content, (dict, list)):
-                content = json.dumps(content)
-            total += len(str(content))
-        return total // 4
+        return sum(content_length(msg.get('content', '')) for msg in messages) // 4
+
+    async def summarize(messages, full_model, prompt, ctx):
+        """Summarize messages as up to block_count concurrent blocks."""
+
+        size = -(-len(messages) // block_count)
+        blocks = [messages[i:i + size] for i in range(0, len(messages), size)]
+        if len(blocks) > 1:
+            ctx.log(f"[context_compaction] Summarizing {len(blocks)} blocks concurrently")
+
+        summaries = await asyncio.gather(*(
+            cached_summary(build_text(block), full_model, prompt, ctx) for block in blocks
+        ))
+
+        if not all(summaries):
+            return None
+        return '\n\n'.join(summaries)
+
+    async def cached_summary(conversation_text, full_model, prompt, ctx):
+        """Generate a summary, reusing a recent one for identical input."""
+
+        # Model and prompt are fixed at install, so the text alone is the key
+        key = text_digest(conversation_text)
+        summary = summary_cache.get(key)
+        if summary:
+            summary_cache.move_to_end(key)
+            ctx.log(f"[context_compaction] Reusing cached summary")
+            return summary
+
+        summary = await generate_summary(conversation_text, full_model, prompt, ctx)
+        if summary:
+            summary_cache[key] = summary
+            if len(summary_cache) > SUMMARY_CACHE_SIZE:
+                summary_cache.popitem(last=False)
+        return summary
 
     async def generate_summary(conversation_text, full_model, prompt, ctx):
         """
@@ -178,6 +320,8 @@ def __install__(ctx):
                 system_prompt=prompt,
                 text=conversation_text
             )
+            if summary_max_tokens:
+                summary_chat['max_tokens'] = summary_max_tokens
 
             ctx.log(f"[context_compaction] Calling LLM: {full_model}")
 
@@ -2,6 +2,11 @@
 Simple LLMS extension that registers a /compact command filter.
 """
 
+import re
+
+# Matches a /compact command at the start of a message
+COMPACT_COMMAND = re.compile(r'\s*/compact(?:\s|$)')
+
 def __install__(ctx):
     """
     Install hook - registers filters and other server enhancements.
@@ -46,7 +51,7 @@ def __install__(ctx):
                 ctx.log(f"[context_compaction] Text content: {text_content}")
 
                 # Check if message starts with /compact
-                if text_content and text_content.strip().startswith('/compact'):
+                if text_content and COMPACT_COMMAND.match(text_content):
                     ctx.log(f"[context_compaction] ✓ Intercepted /compact command")
 
                     # Replace the message content with our test message